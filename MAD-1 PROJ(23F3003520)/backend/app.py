@@ -1,22 +1,102 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+import json
+import sqlite3
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, has_request_context, g
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, func, text, table, literal_column
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload, selectinload, contains_eager, raiseload, make_transient_to_detached
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from datetime import datetime, timedelta, date
 from functools import wraps
+from collections import defaultdict
+from contextlib import closing
 
 
 
 # Configuration & Initialization
 app = Flask(__name__, template_folder='../frontend/templates', static_folder='../frontend/static')
+DB_PATH = os.path.join(os.path.dirname(__file__), 'instance', 'hospital.db')
 app.config['SECRET_KEY'] = 'change-this-secret-key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(os.path.dirname(__file__), 'instance', 'hospital.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DB_PATH
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True, 'pool_recycle': 3600,
+    'connect_args': {'check_same_thread': False, 'timeout': 5}}
+# Single writer connection (SQLite allows one writer anyway); the read-only pool gets one connection per
+# request thread (THREADS, set by gunicorn.conf.py) so threaded workers never queue for a reader
+app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(pool_size=1, max_overflow=0)
+app.config['SQLALCHEMY_BINDS'] = {'read': {'url': f'sqlite:///file:{DB_PATH}?mode=ro&uri=true',
+    'pool_size': int(os.environ.get('THREADS', os.cpu_count() or 1)), 'max_overflow': 0, 'pool_pre_ping': True, 'pool_recycle': 3600,
+    'connect_args': {'check_same_thread': False, 'timeout': 5}}}
 
 os.makedirs(os.path.join(os.path.dirname(__file__), 'instance'), exist_ok=True)
 
-db = SQLAlchemy(app)
+class RoutingSession(Session):
+    """Inside a request, reads go to the read-only engine. A flush or DML statement switches the rest of the
+    transaction to the writer, so only transactions that actually write take the write lock."""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or getattr(clause, 'is_dml', False): self.info['writing'] = True
+            if not self.info.get('writing'): return self._db.engines['read']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def end_writing(session, transaction):
+    if transaction.parent is None: session.info.pop('writing', None)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+# SQLite tuning: WAL lets dashboard reads run alongside bookings, busy_timeout waits instead of failing on locks
+SQLITE_PRAGMAS = ('journal_mode=WAL', 'synchronous=NORMAL', 'busy_timeout=5000', 'cache_size=-20000',
+                  'temp_store=memory', 'foreign_keys=ON')
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # Let SQLAlchemy's begin event issue BEGIN itself instead of pysqlite's deferred implicit one
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS: cursor.execute(f'PRAGMA {pragma}')
+    cursor.close()
+
+def begin_immediate(conn):
+    # Take the write lock up front so concurrent writers wait on busy_timeout instead of deadlocking on upgrade
+    conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+def begin_deferred(conn): conn.exec_driver_sql('BEGIN')
+
+# Per-request SQL statement count, logged in debug mode so N+1 regressions show up while developing
+QUERY_COUNT_THRESHOLD = 10
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context(): g.query_count = g.get('query_count', 0) + 1
+
+with app.app_context():
+    for key, engine in db.engines.items():
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+        event.listen(engine, 'begin', begin_deferred if key == 'read' else begin_immediate)
+        event.listen(engine, 'before_cursor_execute', count_query)
+
+@app.after_request
+def log_query_count(response):
+    if app.debug and g.get('query_count', 0) > QUERY_COUNT_THRESHOLD:
+        app.logger.warning('%s %s ran %d SQL queries', request.method, request.path, g.query_count)
+    return response
+
+# Optional Redis: server-side sessions plus a short-lived cache of User rows for load_user
+REDIS_URL = os.environ.get('REDIS_URL')
+USER_CACHE_TTL = 60
+redis_client = None
+if REDIS_URL:
+    import redis
+    from flask_session import Session as FlaskSession
+    redis_client = redis.Redis.from_url(REDIS_URL)
+    app.config.update(SESSION_TYPE='redis', SESSION_REDIS=redis_client)
+    FlaskSession(app)
+
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -31,6 +111,9 @@ def server_error(e):
     return redirect(url_for("index"))
 
 # Database Models
+# argon2id runs in native code; tune these so a login stays well under 100 ms on the deployment hardware
+_ph = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=2)
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(180), unique=True, nullable=False)
@@ -39,29 +122,44 @@ class User(UserMixin, db.Model):
     role = db.Column(db.String(50), nullable=False)
     full_name = db.Column(db.String(80), nullable=False)
     phone = db.Column(db.String(10))
-    is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    is_active = db.Column(db.Boolean, default=True, index=True)
+    created_at = db.Column(db.DateTime, server_default=func.current_timestamp())
+    # Loader strategies live here: profiles and their users are needed on every role-specific page, so join them;
+    # collections stay lazy 'select' (never 'dynamic') and listings opt into eager loads per query
+    doctor_profile = db.relationship('Doctor', back_populates='user', uselist=False, lazy='joined')
+    patient_profile = db.relationship('Patient', back_populates='user', uselist=False, lazy='joined')
     
-    def set_password(self, password): self.password_hash = generate_password_hash(password)
-    def check_password(self, password): return check_password_hash(self.password_hash, password)
+    def set_password(self, password): self.password_hash = _ph.hash(password)
+    def check_password(self, password):
+        # Successful checks may upgrade the stored hash; the caller commits
+        if self.password_hash.startswith('$argon2'):
+            try: _ph.verify(self.password_hash, password)
+            except (VerificationError, InvalidHashError): return False
+            if _ph.check_needs_rehash(self.password_hash): self.set_password(password)
+            return True
+        # Legacy werkzeug hash (compared in constant time by werkzeug itself)
+        if not check_password_hash(self.password_hash, password): return False
+        self.set_password(password)
+        return True
 
 class Department(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=True, nullable=False)
     description = db.Column(db.Text)
-    doctors = db.relationship('Doctor', backref='department', lazy=True)
+    doctors = db.relationship('Doctor', back_populates='department', lazy='select')
 
 class Doctor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
-    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False)
+    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False, index=True)
     specialization = db.Column(db.String(80))
     qualification = db.Column(db.String(100))
     experience_years = db.Column(db.Integer)
     consultation_fee = db.Column(db.Float, default=0.0)
-    user = db.relationship('User', backref=db.backref('doctor_profile', uselist=False))
-    appointments = db.relationship('Appointment', backref='doctor', lazy=True)
-    availability = db.relationship('DoctorAvailability', backref='doctor', cascade='all, delete-orphan')
+    user = db.relationship('User', back_populates='doctor_profile', lazy='joined')
+    department = db.relationship('Department', back_populates='doctors')
+    appointments = db.relationship('Appointment', back_populates='doctor', lazy='select')
+    availability = db.relationship('DoctorAvailability', back_populates='doctor', lazy='select', cascade='all, delete-orphan')
 
 class Patient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -71,18 +169,26 @@ class Patient(db.Model):
     blood_group = db.Column(db.String(6))
     address = db.Column(db.Text)
     emergency_contact = db.Column(db.String(10))
-    user = db.relationship('User', backref=db.backref('patient_profile', uselist=False))
-    appointments = db.relationship('Appointment', backref='patient', lazy=True)
+    user = db.relationship('User', back_populates='patient_profile', lazy='joined')
+    appointments = db.relationship('Appointment', back_populates='patient', lazy='select')
 
 class DoctorAvailability(db.Model):
+    __table_args__ = (db.Index('ux_avail_doctor_date', 'doctor_id', 'date', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
     date = db.Column(db.Date, nullable=False)
     start_time = db.Column(db.Time, nullable=False)
     end_time = db.Column(db.Time, nullable=False)
     is_available = db.Column(db.Boolean, default=True)
+    doctor = db.relationship('Doctor', back_populates='availability')
 
 class Appointment(db.Model):
+    __table_args__ = (db.Index('ix_appt_doctor_date', 'doctor_id', 'appointment_date'),
+                      db.Index('ix_appt_patient_date', 'patient_id', 'appointment_date'),
+                      db.Index('ix_appt_status', 'status'),
+                      # At most one booked appointment per doctor slot; cancelled ones don't block rebooking
+                      db.Index('ux_appt_slot', 'doctor_id', 'appointment_date', 'appointment_time', unique=True,
+                               sqlite_where=text("status = 'Booked'")))
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
@@ -90,8 +196,10 @@ class Appointment(db.Model):
     appointment_time = db.Column(db.Time, nullable=False)
     status = db.Column(db.String(50), default='Booked')
     reason = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    treatment = db.relationship('Treatment', backref='appointment', uselist=False, cascade='all, delete-orphan')
+    created_at = db.Column(db.DateTime, server_default=func.current_timestamp())
+    doctor = db.relationship('Doctor', back_populates='appointments')
+    patient = db.relationship('Patient', back_populates='appointments')
+    treatment = db.relationship('Treatment', back_populates='appointment', uselist=False, cascade='all, delete-orphan')
 
 class Treatment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -100,11 +208,79 @@ class Treatment(db.Model):
     prescription = db.Column(db.Text)
     notes = db.Column(db.Text)
     follow_up_date = db.Column(db.Date)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=func.current_timestamp())
+    appointment = db.relationship('Appointment', back_populates='treatment')
 
 # Helper Functions
+# Eager-load both sides of an appointment for listings that show patient and doctor names
+APPOINTMENT_PARTIES = (joinedload(Appointment.doctor).joinedload(Doctor.user),
+                       joinedload(Appointment.patient).joinedload(Patient.user))
+
 @login_manager.user_loader
-def load_user(user_id): return User.query.get(int(user_id))
+def load_user(user_id): return fetch_user(int(user_id))
+
+def fetch_user(user_id):
+    if redis_client is None: return db.session.get(User, user_id)
+    cached = redis_client.get(f'user:{user_id}')
+    if cached: return user_from_cache(json.loads(cached))
+    user = db.session.get(User, user_id)
+    if user: redis_client.setex(f'user:{user_id}', USER_CACHE_TTL, json.dumps(user_to_cache(user), default=str))
+    return user
+
+# The cache holds plain JSON column values only (never password_hash), so nothing in Redis gets unpickled
+def _columns(obj, exclude=()): return {c.key: getattr(obj, c.key) for c in obj.__table__.columns if c.key not in exclude}
+
+def _rebuild(model, data):
+    for c in model.__table__.columns:
+        if isinstance(data.get(c.key), str) and c.type.python_type in (date, datetime):
+            data[c.key] = c.type.python_type.fromisoformat(data[c.key])
+    return model(**data)
+
+def user_to_cache(user):
+    return {'user': _columns(user, exclude=('password_hash',)),
+            'doctor': user.doctor_profile and _columns(user.doctor_profile),
+            'patient': user.patient_profile and _columns(user.patient_profile)}
+
+def user_from_cache(data):
+    # Re-attach as persistent without a SELECT; password_hash is left unloaded and fetched only if accessed
+    user = _rebuild(User, data['user'])
+    user.doctor_profile = data['doctor'] and _rebuild(Doctor, data['doctor'])
+    user.patient_profile = data['patient'] and _rebuild(Patient, data['patient'])
+    for obj in (user, user.doctor_profile, user.patient_profile):
+        if obj is not None: make_transient_to_detached(obj)
+    return db.session.merge(user, load=False)
+
+def forget_user(user_id):
+    if redis_client is not None: redis_client.delete(f'user:{user_id}')
+
+@app.before_request
+def load_profile():
+    # Profiles are joined onto the user row, so this costs no extra query per request
+    g.doctor = g.patient = None
+    if request.endpoint != 'static' and current_user.is_authenticated:
+        g.doctor, g.patient = current_user.doctor_profile, current_user.patient_profile
+
+# Departments are effectively static, so keep plain (id, name, description) rows in memory instead of
+# re-querying on every page; call invalidate_departments() after any change to the table
+_DEPT_CACHE = {'data': None}
+
+def get_departments():
+    if _DEPT_CACHE['data'] is None:
+        _DEPT_CACHE['data'] = db.session.query(Department.id, Department.name, Department.description)\
+            .order_by(Department.id).all()
+    return _DEPT_CACHE['data']
+
+def invalidate_departments(): _DEPT_CACHE['data'] = None
+
+_DATE_FMT, _TIME_FMT = '%Y-%m-%d', '%H:%M'
+
+def parse_date(s): return datetime.strptime(s, _DATE_FMT).date() if s else None
+def parse_time(s): return datetime.strptime(s, _TIME_FMT).time() if s else None
+
+PER_PAGE = 25
+
+def paginate(query):
+    return query.paginate(page=request.args.get('page', 1, type=int), per_page=PER_PAGE, error_out=False)
 
 def role_required(role):
     def decorator(f):
@@ -117,10 +293,65 @@ def role_required(role):
         return decorated_function
     return decorator
 
+# Trigram FTS5 indexes (kept in sync by triggers) so substring searches don't scan the base tables
+SEARCH_INDEXES = {'user': ('full_name', 'phone'), 'doctor': ('specialization', 'qualification')}
+
+def _has_trigram_fts():
+    # The trigram tokenizer needs SQLite 3.34+ built with FTS5; older builds keep using plain LIKE searches
+    try:
+        with closing(sqlite3.connect(':memory:')) as conn: conn.execute("CREATE VIRTUAL TABLE t USING fts5(a, tokenize='trigram')")
+    except sqlite3.OperationalError: return False
+    return True
+
+FTS_TRIGRAM = _has_trigram_fts()
+
+def create_search_indexes():
+    if not FTS_TRIGRAM: return
+    with db.engine.begin() as conn:
+        for name, cols in SEARCH_INDEXES.items():
+            fts = f'{name}_fts'
+            if conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = ?", (fts,)).first(): continue
+            col_list, new_vals, old_vals = ', '.join(cols), ', '.join(f'new.{c}' for c in cols), ', '.join(f'old.{c}' for c in cols)
+            conn.exec_driver_sql(f"CREATE VIRTUAL TABLE {fts} USING fts5({col_list}, content='{name}', "
+                                 f"content_rowid='id', tokenize='trigram')")
+            conn.exec_driver_sql(f"CREATE TRIGGER {fts}_ai AFTER INSERT ON {name} BEGIN "
+                                 f"INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals}); END")
+            conn.exec_driver_sql(f"CREATE TRIGGER {fts}_ad AFTER DELETE ON {name} BEGIN "
+                                 f"INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals}); END")
+            conn.exec_driver_sql(f"CREATE TRIGGER {fts}_au AFTER UPDATE OF {col_list} ON {name} BEGIN "
+                                 f"INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals}); "
+                                 f"INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals}); END")
+            conn.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+def text_search(column, q):
+    # Trigram MATCH needs at least 3 characters; shorter terms (or no FTS support) fall back to a plain LIKE
+    if not FTS_TRIGRAM or len(q) < 3: return column.ilike(f'%{q}%')
+    fts = f'{column.table.name}_fts'
+    match = literal_column(fts).op('MATCH')(f'{column.key} : "' + q.replace('"', '""') + '"')
+    return column.table.c.id.in_(db.select(literal_column('rowid')).select_from(table(fts)).where(match))
+
 def init_db():
     with app.app_context():
         db.create_all()
-        if not User.query.filter_by(username='admin').first():
+        # Older databases may hold double bookings from before ux_appt_slot existed, which would make creating the
+        # unique index below fail; refuse to start and list them so an admin can cancel or reschedule by hand
+        with db.engine.connect() as conn:
+            has_slot_index = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_appt_slot'")).first()
+            clashes = [] if has_slot_index else conn.execute(text("SELECT doctor_id, appointment_date, appointment_time, COUNT(*) FROM appointment "
+                "WHERE status = 'Booked' GROUP BY doctor_id, appointment_date, appointment_time HAVING COUNT(*) > 1")).all()
+        if clashes:
+            raise RuntimeError("Cannot create ux_appt_slot, these slots are double-booked (doctor_id, date, time, bookings): "
+                + '; '.join(', '.join(str(v) for v in row) for row in clashes))
+        # create_all skips existing tables, so add any indexes introduced since the database was created
+        for t in db.metadata.sorted_tables:
+            for index in t.indexes: index.create(db.engine, checkfirst=True)
+        create_search_indexes()
+        # Tables created before created_at got a server default: fill it in on insert instead
+        for t in ('user', 'appointment', 'treatment'):
+            db.session.execute(text(f"CREATE TRIGGER IF NOT EXISTS {t}_created_at AFTER INSERT ON {t} "
+                f"WHEN new.created_at IS NULL BEGIN UPDATE {t} SET created_at = CURRENT_TIMESTAMP WHERE id = new.id; END"))
+        db.session.commit()
+        if not db.session.query(User.query.filter_by(username='admin').exists()).scalar():
             admin = User(username='admin', email='admin@hospital.com', role='admin', full_name='Admin', phone='1234567890')
             admin.set_password('admin123')
             db.session.add(admin)
@@ -128,13 +359,16 @@ def init_db():
             print("Admin: admin/admin123")
         
         if Department.query.count()==0:
-            for name, desc in [('Cardiology', 'Heart'), ('Neurology', 'Brain'), ('Orthopedics', 'Bones'), 
-                               ('Pediatrics', 'Children'), ('Dermatology', 'Skin'), ('General Medicine', 'General')]:
-                db.session.add(Department(name=name, description=desc))
+            db.session.bulk_insert_mappings(Department, [{'name': name, 'description': desc} for name, desc in
+                [('Cardiology', 'Heart'), ('Neurology', 'Brain'), ('Orthopedics', 'Bones'),
+                 ('Pediatrics', 'Children'), ('Dermatology', 'Skin'), ('General Medicine', 'General')]])
             db.session.commit()
+            invalidate_departments()
             print("Departments created")
 
 # Routes - Home & Auth
+_DUMMY_HASH = _ph.hash('dummy')
+
 @app.route('/')
 def index(): return render_template('index.html')
 
@@ -143,7 +377,11 @@ def login():
     if current_user.is_authenticated: return redirect(url_for('dashboard_redirect'))
     if request.method == 'POST':
         user = User.query.filter_by(username=request.form.get('username')).first()
-        if user and user.check_password(request.form.get('password')) and user.is_active:
+        password = request.form.get('password') or ''
+        # Unknown usernames still pay for a hash so response time doesn't reveal which accounts exist
+        if user is None: User(password_hash=_DUMMY_HASH).check_password(password)
+        elif user.check_password(password) and user.is_active:
+            db.session.commit()
             login_user(user)
             flash(f'Welcome {user.full_name}', 'success')
             return redirect(url_for('dashboard_redirect'))
@@ -164,7 +402,7 @@ def register():
         if request.form.get('password') != request.form.get('confirm_password'):
             flash('Passwords do not match', 'danger')
             return redirect(url_for('register'))
-        if User.query.filter_by(username=request.form.get('username')).first():
+        if db.session.query(User.query.filter_by(username=request.form.get('username')).exists()).scalar():
             flash('Username exists', 'danger')
             return redirect(url_for('register'))
         
@@ -175,7 +413,7 @@ def register():
         db.session.flush()
         
         patient = Patient(user_id=user.id, 
-                         date_of_birth=datetime.strptime(request.form.get('dob'), '%Y-%m-%d').date() if request.form.get('dob') else None,
+                         date_of_birth=parse_date(request.form.get('dob')),
                          gender=request.form.get('gender'), blood_group=request.form.get('blood_group'),
                          address=request.form.get('address'), emergency_contact=request.form.get('emergency_contact'))
         db.session.add(patient)
@@ -194,12 +432,15 @@ def dashboard_redirect():
 @login_required
 @role_required('admin')
 def admin_dashboard():
+    # All four counters as scalar subqueries of a single SELECT
+    counts = db.session.query(
+        db.select(func.count(Doctor.id)).join(User).where(User.is_active).scalar_subquery(),
+        db.select(func.count(Patient.id)).join(User).where(User.is_active).scalar_subquery(),
+        db.select(func.count(Appointment.id)).scalar_subquery(),
+        db.select(func.count(Appointment.id)).where(Appointment.status=='Booked').scalar_subquery()).one()
     return render_template('admin/dashboard.html',
-        total_doctors=Doctor.query.join(User).filter(User.is_active).count(),
-        total_patients=Patient.query.join(User).filter(User.is_active).count(),
-        total_appointments=Appointment.query.count(),
-        pending_appointments=Appointment.query.filter_by(status='Booked').count(),
-        recent_appointments=Appointment.query.order_by(Appointment.created_at.desc()).limit(5).all())
+        total_doctors=counts[0], total_patients=counts[1], total_appointments=counts[2], pending_appointments=counts[3],
+        recent_appointments=Appointment.query.options(*APPOINTMENT_PARTIES).order_by(Appointment.created_at.desc()).limit(5).all())
 
 @app.route('/admin/add-doctor', methods=['GET', 'POST'])
 @login_required
@@ -219,19 +460,21 @@ def add_doctor():
         db.session.commit()
         flash('Doctor added', 'success')
         return redirect(url_for('admin_doctors'))
-    return render_template('admin/add_doctor.html', departments=Department.query.all())
+    return render_template('admin/add_doctor.html', departments=get_departments())
 
 @app.route('/admin/doctors')
 @login_required
 @role_required('admin')
 def admin_doctors():
-    return render_template('admin/doctors.html', doctors=Doctor.query.join(User).filter(User.is_active).all())
+    pagination = paginate(Doctor.query.join(User).filter(User.is_active)
+        .options(contains_eager(Doctor.user), joinedload(Doctor.department)).order_by(Doctor.id))
+    return render_template('admin/doctors.html', doctors=pagination.items, pagination=pagination)
 
 @app.route('/admin/edit-doctor/<int:doctor_id>', methods=['GET', 'POST'])
 @login_required
 @role_required('admin')
 def edit_doctor(doctor_id):
-    doctor = Doctor.query.get_or_404(doctor_id)
+    doctor = db.get_or_404(Doctor, doctor_id)
     if request.method == 'POST':
         doctor.user.full_name = request.form.get('full_name')
         doctor.user.email = request.form.get('email')
@@ -243,16 +486,19 @@ def edit_doctor(doctor_id):
         doctor.consultation_fee = float(request.form.get('consultation_fee', 0))
         if request.form.get('password'): doctor.user.set_password(request.form.get('password'))
         db.session.commit()
+        forget_user(doctor.user_id)
         flash('Updated', 'success')
         return redirect(url_for('admin_doctors'))
-    return render_template('admin/edit_doctor.html', doctor=doctor, departments=Department.query.all())
+    return render_template('admin/edit_doctor.html', doctor=doctor, departments=get_departments())
 
 @app.route('/admin/delete-doctor/<int:doctor_id>', methods=['POST'])
 @login_required
 @role_required('admin')
 def delete_doctor(doctor_id):
-    Doctor.query.get_or_404(doctor_id).user.is_active = False
+    doctor = db.get_or_404(Doctor, doctor_id)
+    doctor.user.is_active = False
     db.session.commit()
+    forget_user(doctor.user_id)
     flash('Doctor deactivated', 'success')
     return redirect(url_for('admin_doctors'))
 
@@ -260,23 +506,26 @@ def delete_doctor(doctor_id):
 @login_required
 @role_required('admin')
 def admin_patients():
-    return render_template('admin/patients.html', patients=Patient.query.join(User).filter(User.is_active).all())
+    pagination = paginate(Patient.query.join(User).filter(User.is_active)
+        .options(contains_eager(Patient.user)).order_by(Patient.id))
+    return render_template('admin/patients.html', patients=pagination.items, pagination=pagination)
 
 @app.route('/admin/edit-patient/<int:patient_id>', methods=['GET', 'POST'])
 @login_required
 @role_required('admin')
 def edit_patient(patient_id):
-    patient = Patient.query.get_or_404(patient_id)
+    patient = db.get_or_404(Patient, patient_id)
     if request.method == 'POST':
         patient.user.full_name = request.form.get('full_name')
         patient.user.email = request.form.get('email')
         patient.user.phone = request.form.get('phone')
-        if request.form.get('dob'): patient.date_of_birth = datetime.strptime(request.form.get('dob'), '%Y-%m-%d').date()
+        if request.form.get('dob'): patient.date_of_birth = parse_date(request.form.get('dob'))
         patient.gender = request.form.get('gender')
         patient.blood_group = request.form.get('blood_group')
         patient.address = request.form.get('address')
         patient.emergency_contact = request.form.get('emergency_contact')
         db.session.commit()
+        forget_user(patient.user_id)
         flash('Updated', 'success')
         return redirect(url_for('admin_patients'))
     return render_template('admin/edit_patient.html', patient=patient)
@@ -285,8 +534,10 @@ def edit_patient(patient_id):
 @login_required
 @role_required('admin')
 def delete_patient(patient_id):
-    Patient.query.get_or_404(patient_id).user.is_active = False
+    patient = db.get_or_404(Patient, patient_id)
+    patient.user.is_active = False
     db.session.commit()
+    forget_user(patient.user_id)
     flash('Patient deactivated', 'success')
     return redirect(url_for('admin_patients'))
 
@@ -295,9 +546,12 @@ def delete_patient(patient_id):
 @role_required('admin')
 def admin_appointments():
     status = request.args.get('status', 'all')
-    query = Appointment.query if status == 'all' else Appointment.query.filter_by(status=status)
+    # raiseload turns any lazy load the template adds later into an error instead of a silent N+1
+    query = Appointment.query.options(*APPOINTMENT_PARTIES, raiseload('*'))
+    if status != 'all': query = query.filter_by(status=status)
+    pagination = paginate(query.order_by(Appointment.appointment_date.desc()))
     return render_template('admin/appointments.html', 
-        appointments=query.order_by(Appointment.appointment_date.desc()).all(), status_filter=status)
+        appointments=pagination.items, pagination=pagination, status_filter=status)
 
 @app.route('/admin/search', methods=['GET', 'POST'])
 @login_required
@@ -311,10 +565,10 @@ def admin_search():
         if search_query:
             if search_type in ['all', 'doctors']:
                 results['doctors'] = Doctor.query.join(User).filter(User.is_active, 
-                    (User.full_name.ilike(f'%{search_query}%')) | (Doctor.specialization.ilike(f'%{search_query}%'))).all()
+                    text_search(User.full_name, search_query) | text_search(Doctor.specialization, search_query)).all()
             if search_type in ['all', 'patients']:
                 results['patients'] = Patient.query.join(User).filter(User.is_active,
-                    (User.full_name.ilike(f'%{search_query}%')) | (User.phone.ilike(f'%{search_query}%'))).all()
+                    text_search(User.full_name, search_query) | text_search(User.phone, search_query)).all()
             if search_type in ['all', 'departments']:
                 results['departments'] = Department.query.filter(Department.name.ilike(f'%{search_query}%')).all()
     return render_template('admin/search.html', results=results, search_query=search_query)
@@ -324,32 +578,35 @@ def admin_search():
 @login_required
 @role_required('doctor')
 def doctor_dashboard():
-    doctor = Doctor.query.filter_by(user_id=current_user.id).first()
+    doctor = g.doctor
     today, week_end = date.today(), date.today() + timedelta(days=7)
+    # One query for the week; today's list and the upcoming booked list are both slices of it
+    week = Appointment.query.filter(Appointment.doctor_id==doctor.id, Appointment.appointment_date>=today,
+            Appointment.appointment_date<=week_end).options(joinedload(Appointment.patient).joinedload(Patient.user))\
+        .order_by(Appointment.appointment_date, Appointment.appointment_time).all()
     return render_template('doctor/dashboard.html', doctor=doctor,
-        upcoming_appointments=Appointment.query.filter(Appointment.doctor_id==doctor.id, 
-            Appointment.appointment_date>=today, Appointment.appointment_date<=week_end, 
-            Appointment.status=='Booked').order_by(Appointment.appointment_date, Appointment.appointment_time).all(),
-        today_appointments=Appointment.query.filter_by(doctor_id=doctor.id, appointment_date=today)
-            .order_by(Appointment.appointment_time).all(),
-        total_patients=len(db.session.query(Appointment.patient_id).filter_by(doctor_id=doctor.id).distinct().all()))
+        upcoming_appointments=[a for a in week if a.status == 'Booked'],
+        today_appointments=[a for a in week if a.appointment_date == today],
+        total_patients=db.session.query(func.count(func.distinct(Appointment.patient_id)))
+            .filter_by(doctor_id=doctor.id).scalar())
 
 @app.route('/doctor/appointments')
 @login_required
 @role_required('doctor')
 def doctor_appointments():
-    doctor = Doctor.query.filter_by(user_id=current_user.id).first()
+    doctor = g.doctor
     status = request.args.get('status', 'all')
-    query = Appointment.query.filter_by(doctor_id=doctor.id)
+    query = Appointment.query.filter_by(doctor_id=doctor.id).options(joinedload(Appointment.patient).joinedload(Patient.user))
     if status != 'all': query = query.filter_by(status=status)
+    pagination = paginate(query.order_by(Appointment.appointment_date.desc()))
     return render_template('doctor/appointments.html', 
-        appointments=query.order_by(Appointment.appointment_date.desc()).all(), status_filter=status)
+        appointments=pagination.items, pagination=pagination, status_filter=status)
 
 @app.route('/doctor/appointment/<int:appointment_id>/complete', methods=['GET', 'POST'])
 @login_required
 @role_required('doctor')
 def complete_appointment(appointment_id):
-    doctor = Doctor.query.filter_by(user_id=current_user.id).first()
+    doctor = g.doctor
     appointment = Appointment.query.filter_by(id=appointment_id, doctor_id=doctor.id).first_or_404()
     if request.method == 'POST':
         appointment.status = 'Completed'
@@ -359,12 +616,11 @@ def complete_appointment(appointment_id):
             treatment.prescription = request.form.get('prescription')
             treatment.notes = request.form.get('notes')
             if request.form.get('follow_up_date'): 
-                treatment.follow_up_date = datetime.strptime(request.form.get('follow_up_date'), '%Y-%m-%d').date()
+                treatment.follow_up_date = parse_date(request.form.get('follow_up_date'))
         else:
             treatment = Treatment(appointment_id=appointment.id, diagnosis=request.form.get('diagnosis'),
                 prescription=request.form.get('prescription'), notes=request.form.get('notes'),
-                follow_up_date=datetime.strptime(request.form.get('follow_up_date'), '%Y-%m-%d').date() 
-                    if request.form.get('follow_up_date') else None)
+                follow_up_date=parse_date(request.form.get('follow_up_date')))
             db.session.add(treatment)
         db.session.commit()
         flash('Appointment completed', 'success')
@@ -375,7 +631,7 @@ def complete_appointment(appointment_id):
 @login_required
 @role_required('doctor')
 def doctor_cancel_appointment(appointment_id):
-    doctor = Doctor.query.filter_by(user_id=current_user.id).first()
+    doctor = g.doctor
     Appointment.query.filter_by(id=appointment_id, doctor_id=doctor.id).first_or_404().status = 'Cancelled'
     db.session.commit()
     flash('Cancelled', 'success')
@@ -385,8 +641,8 @@ def doctor_cancel_appointment(appointment_id):
 @login_required
 @role_required('doctor')
 def patient_history(patient_id):
-    doctor = Doctor.query.filter_by(user_id=current_user.id).first()
-    patient = Patient.query.get_or_404(patient_id)
+    doctor = g.doctor
+    patient = db.get_or_404(Patient, patient_id)
     appointments = Appointment.query.filter_by(patient_id=patient_id, doctor_id=doctor.id, status='Completed')\
         .order_by(Appointment.appointment_date.desc()).all()
     return render_template('doctor/patient_history.html', patient=patient, appointments=appointments)
@@ -395,21 +651,27 @@ def patient_history(patient_id):
 @login_required
 @role_required('doctor')
 def doctor_availability():
-    doctor = Doctor.query.filter_by(user_id=current_user.id).first()
+    doctor = g.doctor
     today, week_end = date.today(), date.today() + timedelta(days=7)
     if request.method == 'POST':
-        DoctorAvailability.query.filter(DoctorAvailability.doctor_id==doctor.id, 
-            DoctorAvailability.date>=today, DoctorAvailability.date<=week_end).delete()
+        rows = []
         for i in range(7):
             avail_date = today + timedelta(days=i)
-            date_str = avail_date.strftime('%Y-%m-%d')
+            date_str = avail_date.strftime(_DATE_FMT)
             if request.form.get(f'available_{date_str}'):
                 start = request.form.get(f'start_time_{date_str}')
                 end = request.form.get(f'end_time_{date_str}')
                 if start and end:
-                    db.session.add(DoctorAvailability(doctor_id=doctor.id, date=avail_date,
-                        start_time=datetime.strptime(start, '%H:%M').time(),
-                        end_time=datetime.strptime(end, '%H:%M').time(), is_available=True))
+                    rows.append({'doctor_id': doctor.id, 'date': avail_date,
+                        'start_time': parse_time(start), 'end_time': parse_time(end), 'is_available': True})
+        # Upsert the checked days in one statement and only delete the days that were unchecked
+        DoctorAvailability.query.filter(DoctorAvailability.doctor_id==doctor.id, DoctorAvailability.date>=today,
+            DoctorAvailability.date<=week_end, DoctorAvailability.date.notin_([r['date'] for r in rows]))\
+            .delete(synchronize_session=False)
+        if rows:
+            stmt = sqlite_insert(DoctorAvailability).values(rows)
+            db.session.execute(stmt.on_conflict_do_update(index_elements=['doctor_id', 'date'],
+                set_={'start_time': stmt.excluded.start_time, 'end_time': stmt.excluded.end_time, 'is_available': True}))
         db.session.commit()
         flash('Availability updated', 'success')
         return redirect(url_for('doctor_availability'))
@@ -423,9 +685,9 @@ def doctor_availability():
 @login_required
 @role_required('patient')
 def patient_dashboard():
-    patient = Patient.query.filter_by(user_id=current_user.id).first()
+    patient = g.patient
     today, week_end = date.today(), date.today() + timedelta(days=7)
-    return render_template('patient/dashboard.html', patient=patient, departments=Department.query.all(),
+    return render_template('patient/dashboard.html', patient=patient, departments=get_departments(),
         upcoming_appointments=Appointment.query.filter(Appointment.patient_id==patient.id,
             Appointment.appointment_date>=today, Appointment.status=='Booked')
             .order_by(Appointment.appointment_date, Appointment.appointment_time).limit(5).all(),
@@ -437,18 +699,19 @@ def patient_dashboard():
 @login_required
 @role_required('patient')
 def patient_profile():
-    patient = Patient.query.filter_by(user_id=current_user.id).first()
+    patient = g.patient
     if request.method == 'POST':
         current_user.full_name = request.form.get('full_name')
         current_user.email = request.form.get('email')
         current_user.phone = request.form.get('phone')
-        if request.form.get('dob'): patient.date_of_birth = datetime.strptime(request.form.get('dob'), '%Y-%m-%d').date()
+        if request.form.get('dob'): patient.date_of_birth = parse_date(request.form.get('dob'))
         patient.gender = request.form.get('gender')
         patient.blood_group = request.form.get('blood_group')
         patient.address = request.form.get('address')
         patient.emergency_contact = request.form.get('emergency_contact')
         if request.form.get('password'): current_user.set_password(request.form.get('password'))
         db.session.commit()
+        forget_user(current_user.id)
         flash('Profile updated', 'success')
         return redirect(url_for('patient_profile'))
     return render_template('patient/profile.html', patient=patient)
@@ -459,37 +722,45 @@ def patient_profile():
 def patient_doctors():
     search = request.args.get('search', '')
     dept_id = request.args.get('department', '')
-    query = Doctor.query.join(User).filter(User.is_active)
-    if search: query = query.filter((User.full_name.ilike(f'%{search}%')) | (Doctor.specialization.ilike(f'%{search}%')))
+    query = Doctor.query.join(User).filter(User.is_active).options(contains_eager(Doctor.user), joinedload(Doctor.department))
+    if search: query = query.filter(text_search(User.full_name, search) | text_search(Doctor.specialization, search))
     if dept_id: query = query.filter(Doctor.department_id==dept_id)
     doctors = query.all()
     today, week_end = date.today(), date.today() + timedelta(days=7)
-    doctor_availability = {d.id: DoctorAvailability.query.filter(DoctorAvailability.doctor_id==d.id,
-        DoctorAvailability.date>=today, DoctorAvailability.date<=week_end, 
-        DoctorAvailability.is_available).all() for d in doctors}
-    return render_template('patient/doctors.html', doctors=doctors, departments=Department.query.all(),
+    doctor_availability = defaultdict(list)
+    for a in DoctorAvailability.query.filter(DoctorAvailability.doctor_id.in_([d.id for d in doctors]),
+            DoctorAvailability.date>=today, DoctorAvailability.date<=week_end,
+            DoctorAvailability.is_available).order_by(DoctorAvailability.date).all():
+        doctor_availability[a.doctor_id].append(a)
+    return render_template('patient/doctors.html', doctors=doctors, departments=get_departments(),
         doctor_availability=doctor_availability, search_query=search, selected_department=dept_id)
 
 @app.route('/patient/book-appointment/<int:doctor_id>', methods=['GET', 'POST'])
 @login_required
 @role_required('patient')
 def book_appointment(doctor_id):
-    patient = Patient.query.filter_by(user_id=current_user.id).first()
-    doctor = Doctor.query.get_or_404(doctor_id)
+    patient = g.patient
+    doctor = db.get_or_404(Doctor, doctor_id)
     today, week_end = date.today(), date.today() + timedelta(days=7)
     availability = DoctorAvailability.query.filter(DoctorAvailability.doctor_id==doctor.id,
         DoctorAvailability.date>=today, DoctorAvailability.date<=week_end, 
         DoctorAvailability.is_available).all()
     if request.method == 'POST':
-        appt_date = datetime.strptime(request.form.get('appointment_date'), '%Y-%m-%d').date()
-        appt_time = datetime.strptime(request.form.get('appointment_time'), '%H:%M').time()
-        if Appointment.query.filter_by(doctor_id=doctor.id, appointment_date=appt_date, 
-                appointment_time=appt_time, status='Booked').first():
-            flash('Time slot already booked', 'danger')
+        appt_date = parse_date(request.form.get('appointment_date'))
+        appt_time = parse_time(request.form.get('appointment_time'))
+        if not appt_date or not appt_time:
+            flash('Choose a date and time', 'danger')
             return redirect(url_for('book_appointment', doctor_id=doctor_id))
         db.session.add(Appointment(patient_id=patient.id, doctor_id=doctor.id, appointment_date=appt_date,
             appointment_time=appt_time, reason=request.form.get('reason'), status='Booked'))
-        db.session.commit()
+        try: db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            # Only a clash on ux_appt_slot means the slot was taken; let any other integrity error propagate
+            if not db.session.query(Appointment.query.filter_by(doctor_id=doctor.id, appointment_date=appt_date,
+                    appointment_time=appt_time, status='Booked').exists()).scalar(): raise
+            flash('Time slot already booked', 'danger')
+            return redirect(url_for('book_appointment', doctor_id=doctor_id))
         flash('Appointment booked', 'success')
         return redirect(url_for('patient_appointments'))
     return render_template('patient/book_appointment.html', doctor=doctor, availability=availability)
@@ -498,18 +769,20 @@ def book_appointment(doctor_id):
 @login_required
 @role_required('patient')
 def patient_appointments():
-    patient = Patient.query.filter_by(user_id=current_user.id).first()
+    patient = g.patient
     status = request.args.get('status', 'all')
-    query = Appointment.query.filter_by(patient_id=patient.id)
+    query = Appointment.query.filter_by(patient_id=patient.id).options(
+        joinedload(Appointment.doctor).joinedload(Doctor.user), selectinload(Appointment.treatment))
     if status != 'all': query = query.filter_by(status=status)
+    pagination = paginate(query.order_by(Appointment.appointment_date.desc()))
     return render_template('patient/my_appointments.html',
-        appointments=query.order_by(Appointment.appointment_date.desc()).all(), status_filter=status)
+        appointments=pagination.items, pagination=pagination, status_filter=status)
 
 @app.route('/patient/appointment/<int:appointment_id>/cancel', methods=['POST'])
 @login_required
 @role_required('patient')
 def cancel_appointment(appointment_id):
-    patient = Patient.query.filter_by(user_id=current_user.id).first()
+    patient = g.patient
     appointment = Appointment.query.filter_by(id=appointment_id, patient_id=patient.id).first_or_404()
     if appointment.status == 'Booked':
         appointment.status = 'Cancelled'
@@ -521,10 +794,11 @@ def cancel_appointment(appointment_id):
 @login_required
 @role_required('patient')
 def treatment_history():
-    patient = Patient.query.filter_by(user_id=current_user.id).first()
-    appointments = Appointment.query.filter_by(patient_id=patient.id, status='Completed')\
-        .order_by(Appointment.appointment_date.desc()).all()
-    return render_template('patient/treatment_history.html', appointments=appointments)
+    patient = g.patient
+    pagination = paginate(Appointment.query.filter_by(patient_id=patient.id, status='Completed').options(
+        joinedload(Appointment.doctor).options(joinedload(Doctor.user), joinedload(Doctor.department)),
+        selectinload(Appointment.treatment)).order_by(Appointment.appointment_date.desc()))
+    return render_template('patient/treatment_history.html', appointments=pagination.items, pagination=pagination)
 
 # Error Handlers
 @app.errorhandler(404)
@@ -0,0 +1,10 @@
+import os
+
+# Usage: gunicorn wsgi:app  (from the backend directory)
+# Threaded workers rather than gevent: sqlite3 runs in C, which gevent cannot make yield, so a request
+# waiting on the write lock would stall every greenlet in its worker. sqlite3 releases the GIL, so threads
+# keep serving reads while one of them waits. THREADS is exported so app.py sizes its read pool to match.
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+worker_class = 'gthread'
+threads = int(os.environ.setdefault('THREADS', '4'))
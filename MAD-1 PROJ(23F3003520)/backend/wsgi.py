@@ -0,0 +1,6 @@
+from app import app, init_db
+
+__all__ = ['app']
+
+# Safe to run from every worker: init_db's writes go through BEGIN IMMEDIATE, so workers seed the database one at a time
+init_db()